@@ -13,56 +13,71 @@ broadsheet (PDF), HTML views, and simple admin endpoints.
 Adjust templates and DB schema mappings as needed.
 """
 import os
+import gzip
+import json
+import hashlib
 import logging
-from io import BytesIO
+import threading
+from cachetools import TTLCache
 from flask import (
-    Flask, render_template, request, redirect, url_for,
-    send_file, make_response, abort, flash
+    Flask, Response, render_template, request, redirect, url_for,
+    make_response, abort, flash
 )
-import pdfkit
+from jinja2 import FileSystemBytecodeCache
 
 from utils import (
-    DB_PATH, get_all_learners, get_learner_by_id,
-    get_broadsheet_data, get_all_learners_with_reports
+    DB_PATH, close_conn, get_all_grades, get_all_learners, get_learner_by_id,
+    get_learners_full_by_grade, get_broadsheet_data, get_all_learners_with_reports
 )
+from pdf_render import render_pdf, render_pdf_pages, start_renderer
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET", "dev-secret")  # change in prod
+if os.environ.get("FLASK_DEBUG", "1") != "1":
+    # In production keep compiled templates on disk so new workers skip the parse/compile step
+    _jinja_cache_dir = os.path.join(app.root_path, ".jinja_cache")
+    os.makedirs(_jinja_cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
 from export_word import export_word_bp
 app.register_blueprint(export_word_bp)
+# Launch the PDF engine now so the first report doesn't pay for it (chromium only)
+start_renderer()
+
+# Rendered dashboard pages keyed by the grade list: (html, gzipped html)
+_dashboard_cache = TTLCache(maxsize=8, ttl=60)
+_dashboard_cache_lock = threading.Lock()
+
 
 # Add dashboard route for landing page (after app creation)
 @app.route('/dashboard')
 def dashboard():
-    from utils import get_all_grades
     grades = get_all_grades()
-    return render_template('landing.html', grades=grades)
+    # Only the grade list varies, so render and compress once per distinct list
+    key = tuple(grades)
+    with _dashboard_cache_lock:
+        page = _dashboard_cache.get(key)
+    if page is None:
+        html = render_template('landing.html', grades=grades).encode("utf-8")
+        page = (html, gzip.compress(html))
+        with _dashboard_cache_lock:
+            _dashboard_cache[key] = page
+    html, gzipped = page
+    if request.accept_encodings["gzip"]:
+        response = Response(gzipped, mimetype="text/html")
+        response.content_encoding = "gzip"
+    else:
+        response = Response(html, mimetype="text/html")
+    response.vary.add("Accept-Encoding")
+    return response
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
-# wkhtmltopdf path via env var (optional)
-WKHTMLTOPDF_PATH = os.environ.get(
-    "WKHTMLTOPDF_PATH",
-    r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe"
-)
-if not os.path.exists(WKHTMLTOPDF_PATH):
-    # try no configuration and rely on system path; warn if not found
-    logger.warning("WKHTMLTOPDF_PATH not found at %s — relying on system PATH", WKHTMLTOPDF_PATH)
-    PDFKIT_CONFIG = None
-else:
-    PDFKIT_CONFIG = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
-
-PDFKIT_OPTIONS = {
-    "page-size": "A4",
-    "encoding": "UTF-8",
-    "enable-local-file-access": None,  # required for wkhtmltopdf to access local CSS
-    "margin-top": "10mm",
-    "margin-bottom": "10mm",
-    "margin-left": "10mm",
-    "margin-right": "10mm",
-}
+# Single-learner PDFs, keyed by the report's ETag
+REPORT_PDF_MAX_AGE = 300
+_report_pdf_cache = TTLCache(maxsize=256, ttl=REPORT_PDF_MAX_AGE)
+_report_pdf_cache_lock = threading.Lock()
 
 # ---------- Routes ----------
 
@@ -75,7 +90,6 @@ def landing():
 @app.route("/learners")
 def index():
     """Shows list of learners and simple actions, with grade filter."""
-    from utils import get_all_grades, get_all_learners
     selected_grade = request.args.get('grade')
     grades = get_all_grades()
     if selected_grade:
@@ -98,7 +112,6 @@ def view_learner(learner_id):
     # For dropdowns
     terms = ['Term 1', 'Term 2', 'Term 3']
     exam_types = ['Opener', 'Midterm', 'Endterm']
-    from utils import get_all_grades
     grades = get_all_grades()
     return render_template("learner_report.html", learner=learner, terms=terms, exam_types=exam_types, grades=grades, selected_term=term, selected_exam_type=exam_type, selected_grade=grade)
 
@@ -107,22 +120,35 @@ def view_learner(learner_id):
 def report_pdf(learner_id):
     """
     Returns a PDF of a single learner report.
-    Uses wkhtmltopdf via pdfkit; streams bytes to client (no temp files).
+    Rendered by pdf_render (wkhtmltopdf by default); streams bytes to client.
     """
     learner = get_learner_by_id(learner_id)
     if not learner:
         abort(404, description="Learner not found")
 
-    # Render HTML using your Jinja template (ensure template exists)
-    html = render_template("learner_report.html", learner=learner)
-    try:
-        pdf_bytes = pdfkit.from_string(html, False, options=PDFKIT_OPTIONS, configuration=PDFKIT_CONFIG)
-    except Exception as e:
-        logger.exception("Failed to generate PDF for learner_id=%s", learner_id)
-        flash("PDF generation failed: " + str(e), "danger")
-        return redirect(url_for("view_learner", learner_id=learner_id))
-
-    return _bytes_to_pdf_response(pdf_bytes, filename=f"report_{learner['id']}.pdf")
+    # The ETag hashes the report data, so it changes whenever a score or class average does
+    etag = hashlib.md5(json.dumps(learner, sort_keys=True, default=str).encode(), usedforsecurity=False).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        with _report_pdf_cache_lock:
+            pdf_bytes = _report_pdf_cache.get(etag)
+        if pdf_bytes is None:
+            # Render HTML using your Jinja template (ensure template exists)
+            html = render_template("learner_report.html", learner=learner)
+            try:
+                pdf_bytes = render_pdf(html)
+            except Exception as e:
+                logger.exception("Failed to generate PDF for learner_id=%s", learner_id)
+                flash("PDF generation failed: " + str(e), "danger")
+                return redirect(url_for("view_learner", learner_id=learner_id))
+            with _report_pdf_cache_lock:
+                _report_pdf_cache[etag] = pdf_bytes
+        response = _bytes_to_pdf_response(pdf_bytes, filename=f"report_{learner['id']}.pdf")
+
+    response.set_etag(etag)
+    response.cache_control.max_age = REPORT_PDF_MAX_AGE
+    return response
 
 
 @app.route("/reports/all.pdf")
@@ -134,7 +160,7 @@ def all_reports_pdf():
     learners = get_all_learners_with_reports()
     html = render_template("all_learners_report.html", learners=learners)
     try:
-        pdf_bytes = pdfkit.from_string(html, False, options=PDFKIT_OPTIONS, configuration=PDFKIT_CONFIG)
+        pdf_bytes = render_pdf(html)
     except Exception as e:
         logger.exception("Failed to generate all reports PDF")
         flash("PDF generation failed: " + str(e), "danger")
@@ -157,7 +183,7 @@ def broadsheet_pdf(grade):
 
     html = render_template("broadsheet.html", grade=grade, broadsheet=data)
     try:
-        pdf_bytes = pdfkit.from_string(html, False, options=PDFKIT_OPTIONS, configuration=PDFKIT_CONFIG)
+        pdf_bytes = render_pdf(html)
     except Exception as e:
         logger.exception("Failed to generate broadsheet PDF")
         abort(500, description="PDF generation failed")
@@ -173,19 +199,19 @@ def grade_reports_pdf(grade):
     """
     selected_term = request.args.get('term')
     selected_exam_type = request.args.get('exam_type')
-    from utils import get_all_learners_with_reports, get_learner_by_id
-    learners = [l for l in get_all_learners_with_reports() if l['grade'] == grade]
+    learners = get_learners_full_by_grade(grade, term=selected_term, exam_type=selected_exam_type)
     # Render each learner's report as a separate page
-    reports_html = ""
     terms = ['Term 1', 'Term 2', 'Term 3']
     exam_types = ['Opener', 'Midterm', 'Endterm']
     grades = [grade]
-    for learner in learners:
-        learner_full = get_learner_by_id(learner['id'], term=selected_term, exam_type=selected_exam_type, grade=grade)
-        reports_html += render_template("learner_report.html", learner=learner_full, terms=terms, exam_types=exam_types, grades=grades, selected_term=selected_term, selected_exam_type=selected_exam_type, selected_grade=grade)
-        reports_html += '<div style="page-break-after: always;"></div>'
+    # Look the template up once rather than per learner
+    learner_tpl = app.jinja_env.get_template("learner_report.html")
+    pages = [
+        render_template(learner_tpl, learner=learner, terms=terms, exam_types=exam_types, grades=grades, selected_term=selected_term, selected_exam_type=selected_exam_type, selected_grade=grade)
+        for learner in learners
+    ]
     try:
-        pdf_bytes = pdfkit.from_string(reports_html, False, options=PDFKIT_OPTIONS, configuration=PDFKIT_CONFIG)
+        pdf_bytes = render_pdf_pages(pages)
     except Exception as e:
         logger.exception("Failed to generate grade reports PDF")
         flash("PDF generation failed: " + str(e), "danger")
@@ -198,23 +224,38 @@ def grade_reports_pdf(grade):
 
 # ---------- Utility endpoints ----------
 
+# Serialized once: the body never changes and monitoring hits this route constantly
+_HEALTH_BODY = json.dumps({"status": "ok", "db": DB_PATH}).encode()
+
+
 @app.route("/health")
 def health():
-    return {"status": "ok", "db": DB_PATH}
+    return Response(_HEALTH_BODY, mimetype="application/json")
 
 
 # ---------- Helpers ----------
 
+PDF_CHUNK_SIZE = 64 * 1024
+
+
 def _bytes_to_pdf_response(pdf_bytes: bytes, filename: str = "report.pdf"):
-    """Helper to convert raw PDF bytes to a Flask response for download/view."""
-    bio = BytesIO(pdf_bytes)
-    bio.seek(0)
-    return send_file(
-        bio,
-        mimetype="application/pdf",
-        as_attachment=False,
-        download_name=filename
-    )
+    """Helper to stream raw PDF bytes to the client (inline view) in fixed-size chunks."""
+    response = Response(_chunked(pdf_bytes), mimetype="application/pdf")
+    response.headers["Content-Length"] = str(len(pdf_bytes))
+    response.headers.set("Content-Disposition", "inline", filename=filename)
+    return response
+
+
+def _chunked(data: bytes, size: int = PDF_CHUNK_SIZE):
+    """Yield `data` in slices of at most `size` bytes."""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+@app.teardown_appcontext
+def _close_db(exc):
+    """Release the thread's shared sqlite connection once the app context ends."""
+    close_conn()
 
 
 # ---------- Error handlers ----------
@@ -7,8 +7,7 @@ import os
 import logging
 from io import BytesIO
 from flask import Blueprint, send_file, abort
-from docx import Document
-from docx.shared import Pt
+from docxtpl import DocxTemplate
 
 from utils import get_learner_by_id
 
@@ -16,44 +15,37 @@ logger = logging.getLogger(__name__)
 
 export_word_bp = Blueprint("export_word", __name__, url_prefix="/export")
 
+# .docx skeleton with Jinja placeholders (styles, headings and the marks table are built in);
+# each export only substitutes the learner's values.
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "learner_report.docx")
+# Read once at import; every export loads from memory instead of the disk
+with open(TEMPLATE_PATH, "rb") as _f:
+    _TEMPLATE_BYTES = _f.read()
 
 
-def _build_document_for_learner(learner: dict) -> Document:
+def _build_document_for_learner(learner: dict) -> DocxTemplate:
     """
-    Convert learner dict into a python-docx Document object.
+    Render the learner report template with the learner dict's values.
     Adjust the fields used below to match your learner dictionary returned by utils.
     """
-    doc = Document()
-    doc.styles['Normal'].font.name = 'Arial'
-    doc.styles['Normal'].font.size = Pt(11)
-
-    # Header / basic info
-    doc.add_heading(learner.get("full_name", "Unnamed Learner"), level=1)
-    doc.add_paragraph(f"Admission No: {learner.get('admission_no', 'N/A')}")
-    doc.add_paragraph(f"Grade: {learner.get('grade', 'N/A')}")
-    doc.add_paragraph(f"Term: {learner.get('term', 'N/A')}")
-    doc.add_paragraph(" ")
-
-    # Example: summary table for marks (if present)
-    marks = learner.get("marks", [])
-    if marks:
-        table = doc.add_table(rows=1, cols=3)
-        hdr_cells = table.rows[0].cells
-        hdr_cells[0].text = "Subject"
-        hdr_cells[1].text = "Mark"
-        hdr_cells[2].text = "Grade"
-        for m in marks:
-            row_cells = table.add_row().cells
-            row_cells[0].text = m.get("subject", "")
-            row_cells[1].text = str(m.get("score", ""))
-            row_cells[2].text = m.get("grade", "")
-    else:
-        doc.add_paragraph("No marks available.")
-
-    # Footer / comments
-    doc.add_paragraph("Comments:")
-    doc.add_paragraph(learner.get("comments", ""))
-
+    context = {
+        "full_name": learner.get("full_name", "Unnamed Learner"),
+        "admission_no": learner.get("admission_no", "N/A"),
+        "grade": learner.get("grade", "N/A"),
+        "term": learner.get("term", "N/A"),
+        "marks": [
+            {
+                "subject": m.get("subject", ""),
+                "score": str(m.get("score", "")),
+                "grade": m.get("grade", ""),
+            }
+            for m in learner.get("marks", [])
+        ],
+        "comments": learner.get("comments", ""),
+    }
+    # A fresh instance per export: rendering mutates the document, so it can't be shared
+    doc = DocxTemplate(BytesIO(_TEMPLATE_BYTES))
+    doc.render(context, autoescape=True)
     return doc
 
 
@@ -0,0 +1,294 @@
+"""
+pdf_render.py - HTML to PDF rendering helpers for school_report_portal
+Renders with wkhtmltopdf, keeping a small pool of long-running processes that take
+jobs over stdin. Multi-report jobs are split into shards that are rendered in
+parallel worker processes and merged back into a single PDF.
+Set PDF_ENGINE=chromium to render with a long-lived headless Chromium instead
+(requires the optional `playwright` package and `playwright install chromium`).
+"""
+import os
+import queue
+import shutil
+import atexit
+import asyncio
+import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from pypdf import PdfWriter
+
+logger = logging.getLogger(__name__)
+
+# wkhtmltopdf path via env var (optional)
+WKHTMLTOPDF_PATH = os.environ.get(
+    "WKHTMLTOPDF_PATH",
+    r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe"
+)
+if not os.path.exists(WKHTMLTOPDF_PATH):
+    # rely on system path; warn if not found
+    logger.warning("WKHTMLTOPDF_PATH not found at %s — relying on system PATH", WKHTMLTOPDF_PATH)
+    WKHTMLTOPDF_PATH = shutil.which("wkhtmltopdf") or "wkhtmltopdf"
+
+WKHTMLTOPDF_OPTIONS = {
+    "page-size": "A4",
+    "encoding": "UTF-8",
+    "enable-local-file-access": None,  # required for wkhtmltopdf to access local CSS
+    "margin-top": "10mm",
+    "margin-bottom": "10mm",
+    "margin-left": "10mm",
+    "margin-right": "10mm",
+}
+# Long-running wkhtmltopdf processes per server process, and how long one job may take
+WKHTMLTOPDF_WORKERS = int(os.environ.get("WKHTMLTOPDF_WORKERS", 2))
+WKHTMLTOPDF_TIMEOUT = float(os.environ.get("WKHTMLTOPDF_TIMEOUT", 120))
+
+PDF_ENGINE = os.environ.get("PDF_ENGINE", "wkhtmltopdf").lower()
+
+# Chromium engine: number of browser tabs kept open and reused for concurrent renders
+CHROMIUM_PAGES = int(os.environ.get("CHROMIUM_PAGES", 4))
+CHROMIUM_PDF_OPTIONS = {
+    "format": "A4",
+    "print_background": True,  # wkhtmltopdf prints backgrounds by default
+    "margin": {"top": "10mm", "bottom": "10mm", "left": "10mm", "right": "10mm"},
+}
+
+PAGE_BREAK = '<div style="page-break-after: always;"></div>'
+
+# Parallel rendering of multi-report PDFs
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+MIN_PAGES_PER_SHARD = 4  # below this, a worker's wkhtmltopdf startup outweighs the gain
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+_chromium: Optional["ChromiumRenderer"] = None
+_chromium_lock = threading.Lock()
+_wkhtmltopdf_pool: Optional["WkhtmltopdfPool"] = None
+_wkhtmltopdf_pool_lock = threading.Lock()
+
+
+class WkhtmltopdfWorker:
+    """
+    A single `wkhtmltopdf --read-args-from-stdin` process that converts jobs one after another,
+    so process start-up and font loading are paid once rather than per PDF.
+    Each job is a line "<input.html> <output.pdf>" written to stdin; wkhtmltopdf reports "Done"
+    on stderr when a conversion finishes and exits if one fails, in which case the next job
+    starts a fresh process. Not thread-safe on its own; WkhtmltopdfPool hands out one per caller.
+    """
+
+    def __init__(self, binary: str = WKHTMLTOPDF_PATH, options: dict = WKHTMLTOPDF_OPTIONS):
+        self._args = [binary, "--read-args-from-stdin"]
+        for key, value in options.items():
+            self._args.append(f"--{key}")
+            if value is not None:
+                self._args.append(value)
+        self._proc = None
+        self._stderr_lines = None
+
+    def render(self, html: str) -> bytes:
+        """Render an HTML string to PDF bytes; raises IOError if wkhtmltopdf fails or times out."""
+        with tempfile.TemporaryDirectory(prefix="report_pdf_") as tmp:
+            src = os.path.join(tmp, "in.html")
+            dst = os.path.join(tmp, "out.pdf")
+            with open(src, "w", encoding="utf-8") as f:
+                f.write(html)
+            self._submit(f"{_quote_arg(src)} {_quote_arg(dst)}\n")
+            try:
+                with open(dst, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise IOError("wkhtmltopdf finished without writing a PDF")
+
+    def close(self) -> None:
+        """Stop the wkhtmltopdf process, if running."""
+        proc, self._proc = self._proc, None
+        if proc is not None and proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def _submit(self, job: str) -> None:
+        if self._proc is None or self._proc.poll() is not None:
+            self._start()
+        self._proc.stdin.write(job.encode("utf-8"))
+        self._proc.stdin.flush()
+        log = []
+        while True:
+            try:
+                line = self._stderr_lines.get(timeout=WKHTMLTOPDF_TIMEOUT)
+            except queue.Empty:
+                self.close()
+                raise IOError(f"wkhtmltopdf timed out after {WKHTMLTOPDF_TIMEOUT:g}s")
+            if line is None:  # process exited: the conversion failed
+                self.close()
+                raise IOError("wkhtmltopdf failed: " + b"".join(log).decode("utf-8", "replace").strip())
+            if line.rstrip().endswith(b"Done"):
+                return
+            log.append(line)
+
+    def _start(self) -> None:
+        self._proc = subprocess.Popen(
+            self._args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        # stderr is drained on a thread so a job can wait on it with a timeout
+        self._stderr_lines = queue.Queue()
+        threading.Thread(
+            target=_pump_lines, args=(self._proc.stderr, self._stderr_lines), daemon=True
+        ).start()
+
+
+class WkhtmltopdfPool:
+    """Fixed set of WkhtmltopdfWorkers; each render borrows one, waiting if all are busy."""
+
+    def __init__(self, size: int = WKHTMLTOPDF_WORKERS):
+        self._workers = [WkhtmltopdfWorker() for _ in range(size)]
+        # LIFO so the most recently used (already running) process is picked first
+        self._idle = queue.LifoQueue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def render(self, html: str) -> bytes:
+        worker = self._idle.get()
+        try:
+            return worker.render(html)
+        finally:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
+
+
+class ChromiumRenderer:
+    """
+    Headless Chromium kept running between requests, rendering HTML to PDF over CDP.
+    Playwright objects belong to the event loop that created them, so the browser lives on
+    its own thread and callers hand jobs to it. A fixed set of tabs is reused; at most
+    `pages` renders run at once and further callers wait for a free tab.
+    """
+
+    def __init__(self, pages: int = CHROMIUM_PAGES):
+        self._n_pages = pages
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chromium-pdf", daemon=True)
+        self._thread.start()
+        self._call(self._start())
+
+    def render(self, html: str) -> bytes:
+        """Render an HTML string to PDF bytes; blocks until a tab is free and the PDF is ready."""
+        return self._call(self._render(html))
+
+    def close(self) -> None:
+        """Shut down the browser and its event loop thread."""
+        self._call(self._stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _start(self):
+        from playwright.async_api import async_playwright
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch()
+        self._idle_pages = asyncio.Queue()
+        for _ in range(self._n_pages):
+            self._idle_pages.put_nowait(await self._browser.new_page())
+
+    async def _render(self, html: str) -> bytes:
+        page = await self._idle_pages.get()
+        try:
+            await page.set_content(html, wait_until="domcontentloaded")
+            return await page.pdf(**CHROMIUM_PDF_OPTIONS)
+        finally:
+            if page.is_closed():
+                page = await self._browser.new_page()
+            self._idle_pages.put_nowait(page)
+
+    async def _stop(self):
+        await self._browser.close()
+        await self._playwright.stop()
+
+
+def start_renderer() -> None:
+    """Start the configured PDF engine ahead of the first request (no-op for wkhtmltopdf)."""
+    if PDF_ENGINE == "chromium":
+        _get_chromium()
+
+
+def render_pdf(html: str) -> bytes:
+    """Render an HTML string to PDF bytes with the configured engine."""
+    if PDF_ENGINE == "chromium":
+        return _get_chromium().render(html)
+    return _get_wkhtmltopdf_pool().render(html)
+
+
+def render_pdf_pages(pages: List[str]) -> bytes:
+    """
+    Render several HTML reports into one PDF, each report starting on a new page.
+    Large jobs are split into contiguous shards rendered in parallel, then merged in order.
+    Chromium lays out the whole document quickly from a warm browser, so it renders in one pass.
+    """
+    if PDF_ENGINE == "chromium":
+        return render_pdf(PAGE_BREAK.join(pages))
+
+    n_shards = min(PDF_WORKERS, len(pages) // MIN_PAGES_PER_SHARD)
+    if n_shards <= 1:
+        return render_pdf(PAGE_BREAK.join(pages))
+
+    shard_size = -(-len(pages) // n_shards)  # ceiling division
+    shards = [PAGE_BREAK.join(pages[i:i + shard_size]) for i in range(0, len(pages), shard_size)]
+    writer = PdfWriter()
+    for chunk in _get_executor().map(render_pdf, shards):
+        writer.append(BytesIO(chunk))
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Return the shared worker pool, starting it on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn (not fork): workers start clean instead of inheriting the server's threads
+            _executor = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+
+def _get_chromium() -> ChromiumRenderer:
+    """Return the shared Chromium renderer, launching the browser on first use."""
+    global _chromium
+    with _chromium_lock:
+        if _chromium is None:
+            _chromium = ChromiumRenderer()
+            atexit.register(_chromium.close)
+        return _chromium
+
+
+def _get_wkhtmltopdf_pool() -> WkhtmltopdfPool:
+    """Return this process's wkhtmltopdf pool; processes start on first use."""
+    global _wkhtmltopdf_pool
+    with _wkhtmltopdf_pool_lock:
+        if _wkhtmltopdf_pool is None:
+            _wkhtmltopdf_pool = WkhtmltopdfPool()
+            atexit.register(_wkhtmltopdf_pool.close)
+        return _wkhtmltopdf_pool
+
+
+def _pump_lines(stream, lines: queue.Queue) -> None:
+    """Copy lines from `stream` into `lines` until EOF, then put None."""
+    for line in iter(stream.readline, b""):
+        lines.put(line)
+    lines.put(None)
+
+
+def _quote_arg(arg: str) -> str:
+    """Quote an argument for wkhtmltopdf's stdin parser (double quotes, backslash escapes)."""
+    return '"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"'
@@ -3,28 +3,110 @@ utils.py - database helpers for school_report_portal
 Provides safe sqlite3 helpers. Adjust SQL to match your actual DB schema.
 """
 import os
+import logging
+from bisect import bisect_right
 import sqlite3
+import threading
 from typing import List, Dict, Optional
 
+import orjson
+from cachetools import TTLCache, cached
+
+logger = logging.getLogger(__name__)
+
 DB_PATH = r"C:\\Users\\offic\\Desktop\\Projects\\misc_scripts\\school_exam_portal.db"
 
 
-def get_conn(path: str = DB_PATH) -> sqlite3.Connection:
-    """Return a sqlite3 connection with row_factory for dict-like rows."""
-    conn = sqlite3.connect(path)
-    conn.row_factory = sqlite3.Row
+_local = threading.local()
+
+# Short-lived caches for the lists rendered on most pages (dropdowns, filters).
+# Call clear_caches() after writing to learners or scores.
+_learners_cache = TTLCache(maxsize=8, ttl=60)
+_learners_with_reports_cache = TTLCache(maxsize=8, ttl=30)  # averages change more often
+_grades_cache = TTLCache(maxsize=8, ttl=60)
+_cache_lock = threading.Lock()
+
+# Remarks bands: a score at or above a threshold moves it into the next label
+_REMARK_THRESHOLDS = (50, 65, 80)
+_REMARK_LABELS = (
+    'below expectations',
+    'approaching expectations',
+    'meeting expectations',
+    'exceeding expectations',
+)
+
+
+def get_conn() -> sqlite3.Connection:
+    """
+    Return this thread's shared sqlite3 connection, with row_factory for dict-like rows.
+    Opened on first use (WAL mode, large page cache, mmap) and kept open until close_conn().
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # report queries use fixed SQL text, so a larger statement cache keeps them all prepared
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        if os.environ.get("SQL_TRACE") == "1":
+            conn.set_trace_callback(logger.debug)  # dev aid: log every statement executed
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+        conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
     return conn
 
 
+def close_conn() -> None:
+    """Close this thread's shared connection, if one is open."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+def clear_caches() -> None:
+    """Drop the cached learner and grade lists so the next call reads the database."""
+    with _cache_lock:
+        _learners_cache.clear()
+        _learners_with_reports_cache.clear()
+        _grades_cache.clear()
+
+
+def ensure_indexes() -> None:
+    """
+    Create the indexes used by the report queries if they don't exist yet.
+    Skipped when the database file is missing; failures are logged, not raised.
+    """
+    sql = """
+    CREATE INDEX IF NOT EXISTS idx_scores_learner ON scores(learner_id, subject_id, term, exam_type);
+    CREATE INDEX IF NOT EXISTS idx_scores_subject ON scores(subject_id, term, exam_type, score);
+    CREATE INDEX IF NOT EXISTS idx_grade_subjects ON grade_subjects(grade, subject_id);
+    CREATE INDEX IF NOT EXISTS idx_learners_grade ON learners(grade, full_name);
+    """
+    if not os.path.exists(DB_PATH):
+        logger.warning("Database not found at %s — skipping index creation", DB_PATH)
+        return
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.executescript(sql)
+    except sqlite3.Error:
+        logger.exception("Failed to create indexes on %s", DB_PATH)
+    finally:
+        conn.close()
+
+
+@cached(cache=_learners_cache, lock=_cache_lock)
 def get_all_learners() -> List[Dict]:
     """
     Return list of learners. Adjust columns to fit your schema.
     Example expected columns: id, full_name, admission_no, grade
+    Cached for 60s; the list is shared between callers, so don't modify it.
     """
     sql = "SELECT id, full_name, grade FROM learners ORDER BY full_name"
-    with get_conn() as conn:
-        cur = conn.execute(sql)
-        rows = [dict(r) for r in cur.fetchall()]
+    conn = get_conn()
+    cur = conn.execute(sql)
+    rows = [dict(r) for r in cur.fetchall()]
     return rows
 
 
@@ -32,127 +114,163 @@ def get_all_learners_with_reports() -> List[Dict]:
     """
     Returns a list of learners with minimal report summary (used for all_learners report).
     Modify query to join marks/averages if your DB supports it.
+    Cached for 30s as one serialized blob; each call returns a fresh list.
     """
+    return orjson.loads(_learners_with_reports_blob())
+
+
+@cached(cache=_learners_with_reports_cache, lock=_cache_lock)
+def _learners_with_reports_blob() -> bytes:
+    """Query behind get_all_learners_with_reports, serialized with orjson for the cache."""
     sql = """
     SELECT l.id, l.full_name, l.grade,
         (SELECT AVG(score) FROM scores s WHERE s.learner_id = l.id) AS average_score
     FROM learners l
     ORDER BY l.full_name
     """
-    with get_conn() as conn:
-        cur = conn.execute(sql)
-        rows = [dict(r) for r in cur.fetchall()]
-    return rows
+    conn = get_conn()
+    cur = conn.execute(sql)
+    return orjson.dumps([dict(r) for r in cur.fetchall()])
 
 
 def get_learner_by_id(learner_id: int, term: str = None, exam_type: str = None, grade: str = None) -> Optional[Dict]:
     """
-    Return detailed learner data including marks, comments, etc. Filters by term, exam_type, and grade if provided.
+    Return detailed learner data including marks, comments, etc. Filters marks by term and exam_type if provided.
+    `grade` is accepted for the report view's filter form but does not change the data.
     """
-    learner_sql = "SELECT id, full_name, grade FROM learners WHERE id = ?"
-    # Get all subjects for this learner's grade (or selected grade)
-    subjects_sql = """
-        SELECT s.id, s.name FROM subjects s
-        JOIN grade_subjects gs ON gs.subject_id = s.id
-        WHERE gs.grade = ?
-        ORDER BY s.name
+    # The learner and their (filtered) scores in one statement; a learner without
+    # matching scores still comes back as one row with NULL score columns
+    learner_sql = """
+        SELECT l.id, l.full_name, l.grade, m.subject_id, m.subject, m.exam_type, m.term, m.score
+        FROM learners l
+        LEFT JOIN (
+            SELECT sc.learner_id, s.id AS subject_id, s.name AS subject, sc.exam_type, sc.term, sc.score
+            FROM scores sc
+            JOIN subjects s ON s.id = sc.subject_id
+            WHERE sc.learner_id = :learner_id
+                AND (:term IS NULL OR sc.term = :term)
+                AND (:exam_type IS NULL OR sc.exam_type = :exam_type)
+        ) m ON m.learner_id = l.id
+        WHERE l.id = :learner_id
+        ORDER BY m.subject
+    """
+    params = _score_filters(term, exam_type)
+    params['learner_id'] = learner_id
+
+    conn = get_conn()
+    rows = conn.execute(learner_sql, params).fetchall()
+    if not rows:
+        return None
+    learner = {'id': rows[0]['id'], 'full_name': rows[0]['full_name'], 'grade': rows[0]['grade']}
+    scores = [r for r in rows if r['subject_id'] is not None]
+    # Class average and highest for each subject, in one query
+    agg = _class_aggregates(conn, term, exam_type)
+    _attach_marks(learner, scores, agg)
+    return learner
+
+
+def get_learners_full_by_grade(grade: str, term: str = None, exam_type: str = None) -> List[Dict]:
     """
-    # Get all scores for this learner, filtered
-    scores_sql_base = """
-        SELECT s.id AS subject_id, s.name AS subject, sc.exam_type, sc.term, sc.score
+    Return detailed learner data (same shape as get_learner_by_id) for every learner in a grade.
+    Uses a fixed number of queries regardless of how many learners the grade has.
+    """
+    learners_sql = "SELECT id, full_name, grade FROM learners WHERE grade = ? ORDER BY full_name"
+    # All scores for the grade's learners, filtered
+    scores_sql = """
+        SELECT sc.learner_id, s.id AS subject_id, s.name AS subject, sc.exam_type, sc.term, sc.score
         FROM scores sc
         JOIN subjects s ON s.id = sc.subject_id
-        WHERE sc.learner_id = ?
-    """
-    scores_filters = []
-    params = [learner_id]
-    if term:
-        scores_filters.append("sc.term = ?")
-        params.append(term)
-    if exam_type:
-        scores_filters.append("sc.exam_type = ?")
-        params.append(exam_type)
-    scores_sql = scores_sql_base
-    if scores_filters:
-        scores_sql += " AND " + " AND ".join(scores_filters)
-    scores_sql += " ORDER BY s.name"
-    # Class average and highest for each subject
-    class_avg_sql = """
-        SELECT AVG(score) as avg_score, MAX(score) as max_score
+        JOIN learners l ON l.id = sc.learner_id
+        WHERE l.grade = :grade
+            AND (:term IS NULL OR sc.term = :term)
+            AND (:exam_type IS NULL OR sc.exam_type = :exam_type)
+        ORDER BY s.name
+    """
+    params = _score_filters(term, exam_type)
+    params['grade'] = grade
+
+    conn = get_conn()
+    learners = [dict(r) for r in conn.execute(learners_sql, (grade,)).fetchall()]
+    if not learners:
+        return []
+    scores = conn.execute(scores_sql, params).fetchall()
+    agg = _class_aggregates(conn, term, exam_type)
+
+    # bucket score rows per learner in one pass
+    scores_by_learner = {}
+    for s in scores:
+        scores_by_learner.setdefault(s['learner_id'], []).append(s)
+
+    for learner in learners:
+        _attach_marks(learner, scores_by_learner.get(learner['id'], []), agg)
+    return learners
+
+
+def _class_aggregates(conn: sqlite3.Connection, term: str = None, exam_type: str = None) -> Dict:
+    """Return {subject_id: (class average, class highest)} for all subjects, filtered."""
+    sql = """
+        SELECT subject_id, AVG(score) AS avg_score, MAX(score) AS max_score
         FROM scores
-        WHERE subject_id = ?
-    """
-    class_avg_filters = []
-    def add_filter(val, col):
-        if val:
-            class_avg_filters.append(f"{col} = ?")
-            return True
-        return False
-    # Get grade for subjects
-    with get_conn() as conn:
-        cur = conn.execute(learner_sql, (learner_id,))
-        row = cur.fetchone()
-        if not row:
-            return None
-        learner = dict(row)
-        grade_val = grade if grade else learner['grade']
-        subjects = cur.execute(subjects_sql, (grade_val,)).fetchall()
-        subject_map = {s['id']: s['name'] for s in subjects}
-        # Get scores for this learner
-        scores = cur.execute(scores_sql, tuple(params)).fetchall()
-        marks = []
-        total_score_obtained = 0
-        total_score_obtainable = 0
-        for s in scores:
-            subj_id = s['subject_id']
-            subj_name = s['subject']
-            exam_type_val = s['exam_type']
-            term_val = s['term']
-            score = s['score']
-            total_score_obtained += score if score is not None else 0
-            total_score_obtainable += 100  # assuming max per subject is 100
-            # Class average/highest filters
-            avg_params = [subj_id]
-            avg_sql = class_avg_sql
-            avg_filters = []
-            if term:
-                avg_filters.append("term = ?")
-                avg_params.append(term)
-            if exam_type:
-                avg_filters.append("exam_type = ?")
-                avg_params.append(exam_type)
-            if avg_filters:
-                avg_sql += " AND " + " AND ".join(avg_filters)
-            avg_row = cur.execute(avg_sql, tuple(avg_params)).fetchone()
-            class_average = round(avg_row['avg_score'], 1) if avg_row and avg_row['avg_score'] is not None else None
-            class_highest = round(avg_row['max_score'], 1) if avg_row and avg_row['max_score'] is not None else None
-            # Remarks
-            if score >= 80:
-                remarks = 'exceeding expectations'
-            elif score >= 65:
-                remarks = 'meeting expectations'
-            elif score >= 50:
-                remarks = 'approaching expectations'
-            else:
-                remarks = 'below expectations'
-            marks.append({
-                'subject': subj_name,
-                'exam_type': exam_type_val,
-                'score': score,
-                'class_average': class_average,
-                'remarks': remarks,
-                'class_highest': class_highest
-            })
-        learner['marks'] = marks
-        learner['total_score_obtainable'] = total_score_obtainable
-        learner['total_score_obtained'] = total_score_obtained
-        learner['average_percentage'] = round((total_score_obtained / total_score_obtainable) * 100, 1) if total_score_obtainable else 0
-        # Comments and dates (placeholder, can be fetched from DB if available)
-        learner['teacher_comments'] = None
-        learner['principal_comments'] = None
-        learner['teacher_date'] = None
-        learner['principal_date'] = None
-    return learner
+        WHERE (:term IS NULL OR term = :term)
+            AND (:exam_type IS NULL OR exam_type = :exam_type)
+        GROUP BY subject_id
+    """
+    return {r['subject_id']: (r['avg_score'], r['max_score']) for r in conn.execute(sql, _score_filters(term, exam_type))}
+
+
+def _score_filters(term: str = None, exam_type: str = None) -> Dict:
+    """
+    Named parameters for the optional term/exam_type filters; empty values mean "all".
+    The SQL text stays the same whichever filters are set, so sqlite reuses the prepared statement.
+    """
+    return {'term': term or None, 'exam_type': exam_type or None}
+
+
+def _attach_marks(learner: Dict, scores, agg: Dict) -> None:
+    """
+    Fill in marks, totals and placeholder comments on a learner dict.
+    `agg` maps subject_id -> (class average, class highest).
+    """
+    marks = []
+    for s in scores:
+        score = s['score']
+        avg_score, max_score = agg.get(s['subject_id'], (None, None))
+        class_average = round(avg_score, 1) if avg_score is not None else None
+        class_highest = round(max_score, 1) if max_score is not None else None
+        marks.append({
+            'subject': s['subject'],
+            'exam_type': s['exam_type'],
+            'score': score,
+            'class_average': class_average,
+            'remarks': _remarks_for(score),
+            'class_highest': class_highest
+        })
+    total_score_obtained, total_score_obtainable, average_percentage = _aggregate_marks([m['score'] for m in marks])
+    learner['marks'] = marks
+    learner['total_score_obtainable'] = total_score_obtainable
+    learner['total_score_obtained'] = total_score_obtained
+    learner['average_percentage'] = average_percentage
+    # Comments and dates (placeholder, can be fetched from DB if available)
+    learner['teacher_comments'] = None
+    learner['principal_comments'] = None
+    learner['teacher_date'] = None
+    learner['principal_date'] = None
+
+
+def _aggregate_marks(scores: List) -> tuple:
+    """
+    Return (total obtained, total obtainable, average percentage) for a list of scores.
+    Missing scores count as 0; each subject is out of 100.
+    """
+    total_obtained = sum(filter(None, scores))
+    total_obtainable = 100 * len(scores)
+    average_percentage = round((total_obtained / total_obtainable) * 100, 1) if total_obtainable else 0
+    return total_obtained, total_obtainable, average_percentage
+
+
+def _remarks_for(score) -> str:
+    """Map a score to its remarks band; a missing score counts as 0."""
+    return _REMARK_LABELS[bisect_right(_REMARK_THRESHOLDS, score or 0)]
 
 
 def get_broadsheet_data(grade: str) -> Dict:
@@ -171,38 +289,43 @@ def get_broadsheet_data(grade: str) -> Dict:
     """
     # Get learners in grade and their scores pivoted
     learners_sql = "SELECT id, full_name FROM learners WHERE grade = ? ORDER BY full_name"
-    marks_sql = "SELECT sc.learner_id, s.name as subject, sc.score FROM scores sc JOIN subjects s ON s.id = sc.subject_id WHERE sc.learner_id IN ({placeholders})"
+    marks_sql = """
+    SELECT sc.learner_id, s.name AS subject, sc.score
+    FROM scores sc
+    JOIN subjects s ON s.id = sc.subject_id
+    JOIN learners l ON l.id = sc.learner_id
+    WHERE l.grade = ?
+    """
 
-    with get_conn() as conn:
-        subjects = [r["name"] for r in conn.execute(subjects_sql).fetchall()]
+    conn = get_conn()
+    subjects = [r["name"] for r in conn.execute(subjects_sql).fetchall()]
 
-        learners = [dict(r) for r in conn.execute(learners_sql, (grade,)).fetchall()]
-        if not learners:
-            return {"subjects": subjects, "learners": []}
+    learners = [dict(r) for r in conn.execute(learners_sql, (grade,)).fetchall()]
+    if not learners:
+        return {"subjects": subjects, "learners": []}
 
-        learner_ids = [str(l["id"]) for l in learners]
-        placeholders = ",".join("?" for _ in learner_ids)
-        marks_query = marks_sql.replace("{placeholders}", placeholders)
-        params = tuple(int(i) for i in learner_ids)
-        rows = conn.execute(marks_query, params).fetchall()
+    rows = conn.execute(marks_sql, (grade,)).fetchall()
 
-        # pivot marks into learner -> {subject: score}
-        marks_by_learner = {}
-        for r in rows:
-            lid = r["learner_id"]
-            marks_by_learner.setdefault(lid, {})[r["subject"]] = r["score"]
+    # pivot marks into learner -> {subject: score} in a single pass
+    marks_by_learner = {l["id"]: {} for l in learners}
+    for lid, subject, score in rows:
+        if lid in marks_by_learner:  # skip learners added since the learners query
+            marks_by_learner[lid][subject] = score
 
-        # attach marks dict to each learner
-        for l in learners:
-            l_id = l["id"]
-            l["marks"] = marks_by_learner.get(l_id, {})
+    # attach marks dict to each learner
+    for l in learners:
+        l["marks"] = marks_by_learner[l["id"]]
 
     return {"subjects": subjects, "learners": learners}
 
 
+@cached(cache=_grades_cache, lock=_cache_lock)
 def get_all_grades() -> list:
-    """Return a sorted list of all unique grades in the learners table."""
+    """Return a sorted list of all unique grades in the learners table (cached for 60s)."""
     sql = "SELECT DISTINCT grade FROM learners ORDER BY grade"
-    with get_conn() as conn:
-        cur = conn.execute(sql)
-        return [r[0] for r in cur.fetchall()]
+    conn = get_conn()
+    cur = conn.execute(sql)
+    return [r[0] for r in cur.fetchall()]
+
+
+ensure_indexes()